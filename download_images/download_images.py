@@ -8,23 +8,35 @@ Uso:
 Ejemplo:
     python download_images/download_images.py "https://blog.myl.cl/hijos-de-daana-aniversario" -o ../recursos-myl/daana-aniv -t 12
 Requisitos:
-    pip install requests beautifulsoup4
+    pip install requests selectolax
 """
 import argparse
+import itertools
+import json
 import os
 import re
+import shutil
+import stat
 import sys
+import tempfile
 import time
+import threading
 from urllib.parse import urljoin, urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
 }
 
+# Sesión única para todo el programa: las conexiones keep-alive se reutilizan entre fases
+# (el pool se dimensiona en main según --threads)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
 MIME_EXT = {
     "image/jpeg": ".jpg",
     "image/jpg": ".jpg",
@@ -39,54 +51,67 @@ MIME_EXT = {
     "application/octet-stream": "",
 }
 
+IMG_SRC_ATTRS = ("src", "data-src", "data-lazy-src", "data-original")
+META_IMAGE_SELECTOR = ('meta[property="og:image"], meta[name="og:image"], '
+                       'meta[property="twitter:image"], meta[name="twitter:image"]')
+
+ABS_HTTP_RE = re.compile(r"https?://", re.IGNORECASE)
+SANITIZE_RE = re.compile(r"[^\w\-. ]+", re.UNICODE)
+SRCSET_RE = re.compile(r"([^\s,]+)\s+(\d+)w")
+# Crear sin pisar; O_BINARY evita la traducción de saltos de línea en Windows
+EXCL_CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+ETAGS_FILE = ".etags.json"  # URL -> ETag/Last-Modified de descargas previas
+
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r"[^\w\-. ]+", "_", name, flags=re.UNICODE)
-    return name or "file"
+    return SANITIZE_RE.sub("_", name) or "file"
 
 def largest_from_srcset(srcset_value: str) -> str:
-    candidates = []
-    for part in srcset_value.split(","):
-        tokens = part.strip().split()
-        url = tokens[0]
-        width = 0
-        if len(tokens) > 1 and tokens[1].endswith("w"):
-            try:
-                width = int(tokens[1][:-1])
-            except ValueError:
-                pass
-        candidates.append((width, url))
-    return max(candidates, key=lambda x: x[0])[1] if candidates else ""
+    # Una pasada del regex sobre los candidatos "url 640w"; se queda con el de mayor ancho
+    best_url, best_width = "", -1
+    for m in SRCSET_RE.finditer(srcset_value):
+        width = int(m.group(2))
+        if width > best_width:
+            best_url, best_width = m.group(1), width
+    if best_url:
+        return best_url
+    # Sin descriptores de ancho (p.ej. "a.jpg 1x, b.jpg 2x"): primer candidato
+    tokens = srcset_value.split(",", 1)[0].split()
+    return tokens[0] if tokens else ""
 
 def find_image_urls(base_url: str) -> list[str]:
-    resp = requests.get(base_url, headers=HEADERS, timeout=30)
+    resp = SESSION.get(base_url, timeout=30)
     resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
+    tree = LexborHTMLParser(resp.text)
 
-    urls = set()
-    for img in soup.find_all("img"):
-        candidates = []
-        src = img.get("src")
-        srcset = img.get("srcset")
-        data_src = img.get("data-src") or img.get("data-lazy-src") or img.get("data-original")
-
-        if src and not src.lower().startswith("data:"):
-            candidates.append(src)
-        if srcset:
-            best = largest_from_srcset(srcset)
+    candidates = []
+    for img in tree.css("img"):
+        attrs = img.attributes  # atributos sin valor vienen como None
+        for attr in IMG_SRC_ATTRS:
+            v = attrs.get(attr)
+            if v and not v.lower().startswith("data:"):
+                candidates.append(v)
+        ss = attrs.get("srcset")
+        if ss:
+            best = largest_from_srcset(ss)
             if best:
                 candidates.append(best)
-        if data_src and not data_src.lower().startswith("data:"):
-            candidates.append(data_src)
 
-        for c in candidates:
-            abs_url = urljoin(base_url, c)
-            if urlparse(abs_url).scheme in ("http", "https"):
-                urls.add(abs_url)
+    urls = set()
+    for c in candidates:
+        # Camino rápido: la mayoría ya viene absoluta, sin pasar por urljoin/urlparse
+        # (esquema en minúsculas: "HTTPS://x" y "https://x" son la misma imagen)
+        m = ABS_HTTP_RE.match(c)
+        if m:
+            urls.add(m.group(0).lower() + c[m.end():])
+            continue
+        abs_url = urljoin(base_url, c)
+        if abs_url.startswith(("http://", "https://")):
+            urls.add(abs_url)
 
-    for meta in ["og:image", "twitter:image"]:
-        tag = soup.find("meta", property=meta) or soup.find("meta", attrs={"name": meta})
-        if tag and tag.get("content"):
-            urls.add(urljoin(base_url, tag["content"]))
+    for meta in tree.css(META_IMAGE_SELECTOR):
+        content = meta.attributes.get("content")
+        if content:
+            urls.add(urljoin(base_url, content))
 
     return sorted(urls)
 
@@ -94,24 +119,85 @@ def guess_ext_from_headers(headers) -> str:
     ctype = headers.get("Content-Type", "").split(";")[0].strip().lower()
     return MIME_EXT.get(ctype, "")
 
-def download_one(url: str, out_dir: str, session: requests.Session, index: int):
+def load_etags(out_dir: str) -> dict:
     try:
-        r = session.get(url, headers=HEADERS, timeout=60, stream=True)
+        with open(os.path.join(out_dir, ETAGS_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_etags(out_dir: str, etags: dict):
+    with open(os.path.join(out_dir, ETAGS_FILE), "w", encoding="utf-8") as f:
+        json.dump(etags, f, indent=1, sort_keys=True)
+
+def download_one(url: str, out_dir: str, session: requests.Session, index: int,
+                 existing: set, etags: dict, lock: threading.Lock):
+    try:
+        # Si ya la bajamos antes (y el archivo sigue ahí), pedimos solo si cambió: el servidor responde 304 sin cuerpo
+        headers = {}
+        cached = etags.get(url)
+        cached_path = os.path.join(out_dir, cached["file"]) if cached else None
+        if cached_path and os.path.exists(cached_path):
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        else:
+            cached_path = None
+        r = session.get(url, headers=headers, timeout=60, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return cached_path, True, "Sin cambios (304)"
         r.raise_for_status()
         base = sanitize_filename(os.path.basename(urlparse(url).path) or f"image_{index}")
         root, ext = os.path.splitext(base)
         if not ext:
             ext = guess_ext_from_headers(r.headers) or ".bin"
             base = root + ext
-        final_path = os.path.join(out_dir, base)
-        counter = 1
-        while os.path.exists(final_path):
-            final_path = os.path.join(out_dir, f"{root}_{counter}{ext}")
-            counter += 1
-        with open(final_path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                if chunk:
-                    f.write(chunk)
+        # Primer nombre libre: el set de nombres ya usados descarta colisiones conocidas sin syscalls
+        # (en minúsculas, para no pisar archivos en sistemas de archivos case-insensitive) y O_EXCL
+        # crea el archivo de forma atómica, sin carreras entre hilos ni con otros procesos.
+        tmp_path = None
+        if cached_path:
+            # La imagen cambió: se reescribe la copia anterior (temporal + os.replace) en vez de sumar un _N
+            final_base, final_path = cached["file"], cached_path
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".", suffix=".part")
+        else:
+            for counter in itertools.count():
+                final_base = base if counter == 0 else f"{root}_{counter}{ext}"
+                with lock:
+                    if final_base.lower() in existing:
+                        continue
+                    existing.add(final_base.lower())
+                final_path = os.path.join(out_dir, final_base)
+                try:
+                    fd = os.open(final_path, EXCL_CREATE_FLAGS, 0o644)
+                    break
+                except FileExistsError:
+                    continue
+        # Copia directa del socket al archivo (sin el generador de iter_content), en bloques de 128 KiB
+        # sobre un buffer de 1 MiB: menos llamadas write() por imagen. decode_content descomprime gzip/deflate.
+        r.raw.decode_content = True
+        try:
+            with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+                shutil.copyfileobj(r.raw, f, length=1 << 17)
+            if tmp_path:
+                # mkstemp crea con 0600: se conservan los permisos de la copia anterior
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(final_path).st_mode))
+                os.replace(tmp_path, final_path)
+        except BaseException:
+            # Sin archivos truncados: la próxima corrida los vería como colisión y escribiría un _N
+            if tmp_path:
+                os.unlink(tmp_path)
+            else:
+                os.unlink(final_path)
+                with lock:
+                    existing.discard(final_base.lower())
+            raise
+        validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if any(validators.values()):
+            with lock:
+                etags[url] = {**validators, "file": final_base}
         return final_path, True, "OK"
     except Exception as e:
         return url, False, f"ERROR: {e}"
@@ -132,24 +218,39 @@ def main():
     out_dir = args.output or f"images_{sanitize_filename(parsed.netloc + parsed.path)}"
     os.makedirs(out_dir, exist_ok=True)
 
-    print(f"Buscando imágenes en: {base_url}")
-    img_urls = find_image_urls(base_url)
-    if not img_urls:
-        print("No se encontraron imágenes")
-        return
-
-    print(f"Descargando {len(img_urls)} imágenes en {out_dir}...")
-    start = time.time()
-    successes = failures = 0
-    with requests.Session() as session:
-        with ThreadPoolExecutor(max_workers=args.threads) as ex:
-            futures = {ex.submit(download_one, u, out_dir, session, i): u for i, u in enumerate(img_urls, 1)}
-            for fut in as_completed(futures):
-                _, ok, msg = fut.result()
-                if ok: successes += 1
-                else: failures += 1
-                print(f"[{'OK' if ok else '!!'}] {msg}")
-    print(f"Listo. Éxitos: {successes}, Fallos: {failures}, Tiempo: {time.time()-start:.1f}s")
+    try:
+        # Pool keep-alive del tamaño de los hilos: con el default (10) cada hilo extra
+        # descarta su conexión y paga un handshake TCP+TLS nuevo por imagen
+        adapter = HTTPAdapter(pool_connections=args.threads, pool_maxsize=args.threads)
+        SESSION.mount("http://", adapter)
+        SESSION.mount("https://", adapter)
+
+        print(f"Buscando imágenes en: {base_url}")
+        img_urls = find_image_urls(base_url)
+        if not img_urls:
+            print("No se encontraron imágenes")
+            return
+
+        print(f"Descargando {len(img_urls)} imágenes en {out_dir}...")
+        start = time.time()
+        successes = failures = 0
+        existing = {name.lower() for name in os.listdir(out_dir)}
+        etags = load_etags(out_dir)
+        lock = threading.Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=args.threads) as ex:
+                futures = {ex.submit(download_one, u, out_dir, SESSION, i, existing, etags, lock): u for i, u in enumerate(img_urls, 1)}
+                for fut in as_completed(futures):
+                    _, ok, msg = fut.result()
+                    if ok: successes += 1
+                    else: failures += 1
+                    print(f"[{'OK' if ok else '!!'}] {msg}")
+        finally:
+            # También ante Ctrl-C/errores: sin esto la próxima corrida re-descarga todo como _N
+            save_etags(out_dir, etags)
+        print(f"Listo. Éxitos: {successes}, Fallos: {failures}, Tiempo: {time.time()-start:.1f}s")
+    finally:
+        SESSION.close()
 
 if __name__ == "__main__":
     main()
@@ -7,21 +7,27 @@ Uso:
   python download_images/download_images_dynamic.py "https://tor.myl.cl/cartas/leyendas_pb_3.0" -o ../recursos-myl/leyendas-3 -t 12 
 
 Requisitos:
-  pip install playwright beautifulsoup4 requests
+  pip install playwright requests
   python -m playwright install chromium
 """
 
 import argparse
+import itertools
+import json
 import os
+import queue
 import re
+import shutil
+import stat
 import sys
+import tempfile
 import time
 import threading
 from urllib.parse import urljoin, urlparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from playwright.sync_api import sync_playwright
 
 HEADERS = {
@@ -30,8 +36,18 @@ HEADERS = {
                    "Chrome/124.0.0.0 Safari/537.36")
 }
 
+# Sesión compartida por todos los hilos de descarga, con los headers fijados una vez
+# (el pool se dimensiona en main según --threads)
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
 IMAGE_EXT_RE = re.compile(r"\.(?:jpg|jpeg|png|webp|gif|bmp|svg|tiff|ico)(?:\?|#|$)", re.IGNORECASE)
 URL_IN_CSS_RE = re.compile(r'url\((?:\'|")?(.*?)(?:\'|")?\)')
+# Recursos que no hace falta bajar en el navegador: para descubrir imágenes basta con su URL
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+ABS_HTTP_RE = re.compile(r"https?://", re.IGNORECASE)
+SANITIZE_RE = re.compile(r"[^\w\-. ]+", re.UNICODE)
+SRCSET_RE = re.compile(r"([^\s,]+)\s+(\d+)w")
 
 MIME_EXT = {
     "image/jpeg": ".jpg", "image/jpg": ".jpg", "image/png": ".png", "image/gif": ".gif",
@@ -40,23 +56,25 @@ MIME_EXT = {
     "application/octet-stream": "",
 }
 
+# Crear sin pisar; O_BINARY evita la traducción de saltos de línea en Windows
+EXCL_CREATE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+ETAGS_FILE = ".etags.json"  # URL -> ETag/Last-Modified de descargas previas
+
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r"[^\w\-. ]+", "_", name, flags=re.UNICODE)
-    return name or "file"
+    return SANITIZE_RE.sub("_", name) or "file"
 
 def largest_from_srcset(srcset_value: str) -> str:
-    candidates = []
-    for part in srcset_value.split(","):
-        tokens = part.strip().split()
-        url = tokens[0]
-        width = 0
-        if len(tokens) > 1 and tokens[1].endswith("w"):
-            try:
-                width = int(tokens[1][:-1])
-            except ValueError:
-                pass
-        candidates.append((width, url))
-    return max(candidates, key=lambda x: x[0])[1] if candidates else ""
+    # Una pasada del regex sobre los candidatos "url 640w"; se queda con el de mayor ancho
+    best_url, best_width = "", -1
+    for m in SRCSET_RE.finditer(srcset_value):
+        width = int(m.group(2))
+        if width > best_width:
+            best_url, best_width = m.group(1), width
+    if best_url:
+        return best_url
+    # Sin descriptores de ancho (p.ej. "a.jpg 1x, b.jpg 2x"): primer candidato
+    tokens = srcset_value.split(",", 1)[0].split()
+    return tokens[0] if tokens else ""
 
 def guess_ext_from_headers(headers) -> str:
     ctype = headers.get("Content-Type", "").split(";")[0].strip().lower()
@@ -66,54 +84,93 @@ def normalize_add(urls_set: set, base_url: str, candidate: str):
     if not candidate:
         return
     candidate = candidate.strip()
-    if not candidate or candidate.lower().startswith("data:"):
+    if not candidate:
+        return
+    # Camino rápido: la mayoría ya viene absoluta, sin pasar por urljoin/urlparse
+    # (esquema en minúsculas: "HTTPS://x" y "https://x" son la misma imagen)
+    m = ABS_HTTP_RE.match(candidate)
+    if m:
+        urls_set.add(m.group(0).lower() + candidate[m.end():])
+        return
+    if candidate.lower().startswith("data:"):
         return
     abs_url = urljoin(base_url, candidate)
-    parsed = urlparse(abs_url)
-    if parsed.scheme in ("http", "https"):
+    if abs_url.startswith(("http://", "https://")):
         urls_set.add(abs_url)
 
+# Escaneo del DOM en dos llamadas que devuelven JSON plano (sin ElementHandles en Python):
+# - IMG_SCAN_JS, vía eval_on_selector_all("img"): el motor de selectores de Playwright también entra
+#   en los shadow roots abiertos, que document.images no ve. Por <img>:
+#   [currentSrc (lo que realmente está usando el navegador), src, srcset, data-src, data-lazy-src, data-original]
+IMG_SCAN_JS = """els => els.map(i => [
+    i.currentSrc, i.getAttribute('src'), i.getAttribute('srcset'),
+    i.getAttribute('data-src'), i.getAttribute('data-lazy-src'), i.getAttribute('data-original')
+])"""
+# - CSS_BG_SCAN_JS: [background-image, base] leídos del CSSOM (reglas de las hojas + estilos inline) en vez
+#   de getComputedStyle sobre cada elemento: O(reglas) en lugar de O(nodos), y también encuentra reglas
+#   cuyo selector aún no coincide con ningún elemento (lazy-load). Las url(...) de una hoja son
+#   relativas a la hoja, no a la página, por eso cada valor va con su base.
+CSS_BG_SCAN_JS = """() => {
+    const bgs = [];
+    const walk = (rules, base) => {
+        for (const r of rules) {
+            const bi = r.style && r.style.backgroundImage;
+            if (bi && bi !== 'none') bgs.push([bi, base]);
+            // @media/@supports anidan reglas; @import trae su propia hoja
+            if (r.cssRules) walk(r.cssRules, base);
+            if (r.styleSheet) {
+                try { walk(r.styleSheet.cssRules, r.styleSheet.href || base); } catch (e) {}
+            }
+        }
+    };
+    for (const sh of document.styleSheets) {
+        // Hojas cross-origin lanzan SecurityError al leer cssRules (sus imágenes igual llegan por red)
+        try { walk(sh.cssRules, sh.href || document.baseURI); } catch (e) {}
+    }
+    for (const el of document.querySelectorAll('[style*=background]')) {
+        const bi = el.style.backgroundImage;
+        if (bi && bi !== 'none') bgs.push([bi, document.baseURI]);
+    }
+    return bgs;
+}"""
+
 def collect_from_dom(page, base_url: str) -> set:
     urls = set()
-    # 1) Todas las <img>
-    img_nodes = page.query_selector_all("img")
-    for img in img_nodes:
-        # currentSrc (lo que realmente está usando el navegador)
-        cs = img.get_attribute("currentSrc")  # a veces None
-        if cs:
-            normalize_add(urls, base_url, cs)
-        # src
-        src = img.get_attribute("src")
-        if src:
-            normalize_add(urls, base_url, src)
-        # data-src/lazy
-        for attr in ("data-src", "data-lazy-src", "data-original"):
-            ds = img.get_attribute(attr)
-            if ds:
-                normalize_add(urls, base_url, ds)
+
+    # 1) Todas las <img> (incluidas las de shadow roots abiertos)
+    for cs, src, ss, *lazy in page.eval_on_selector_all("img", IMG_SCAN_JS):
+        normalize_add(urls, base_url, cs)
+        normalize_add(urls, base_url, src)
+        for ds in lazy:
+            normalize_add(urls, base_url, ds)
         # srcset (elige la de mayor ancho)
-        ss = img.get_attribute("srcset")
         if ss:
-            best = largest_from_srcset(ss)
-            normalize_add(urls, base_url, best)
+            normalize_add(urls, base_url, largest_from_srcset(ss))
 
-    # 2) background-image en CSS
-    # Para rendimiento: recoge solo elementos que tengan style o clase; en páginas chicas puedes usar "*"
-    all_nodes = page.query_selector_all("*")
-    for node in all_nodes:
-        try:
-            # Usa evaluate para leer getComputedStyle
-            bg = page.evaluate("(el) => getComputedStyle(el).backgroundImage", node)
-        except Exception:
-            bg = None
-        if not bg:
-            continue
-        # Puede contener múltiples url(...)
+    # 2) background-image en CSS; puede contener múltiples url(...)
+    for bg, css_base in page.evaluate(CSS_BG_SCAN_JS):
         for m in URL_IN_CSS_RE.finditer(bg):
-            normalize_add(urls, base_url, m.group(1))
+            normalize_add(urls, css_base, m.group(1))
 
     return urls
 
+def force_eager_load(page, timeout_ms=10000):
+    """
+    Fuerza la carga de todas las <img> perezosas del DOM actual (loading=eager, data-src -> src)
+    y espera en un solo ciclo a que terminen o fallen, con tope de timeout_ms.
+    No mueve el scroll: auto_scroll debe barrer la página desde arriba para disparar los
+    lazy-loaders basados en IntersectionObserver (data-srcset, data-bg, <picture>, etc.).
+    """
+    page.evaluate("""(timeoutMs) => {
+        for (const img of document.images) {
+            img.loading = 'eager';
+            const lazy = img.dataset.src || img.dataset.lazySrc || img.dataset.original;
+            if (lazy && img.getAttribute('src') !== lazy) img.src = lazy;
+        }
+        const settled = Promise.all(Array.from(document.images, i => i.decode().catch(() => {})));
+        return Promise.race([settled, new Promise(r => setTimeout(r, timeoutMs))]);
+    }""", timeout_ms)
+
 def auto_scroll(page, max_scrolls=600, sleep_ms=300, stop_when_stable=6, step_px=200):
     """
     Micro-scroll: mueve la ventana en pasos pequeños (step_px).
@@ -171,28 +228,103 @@ def auto_scroll(page, max_scrolls=600, sleep_ms=300, stop_when_stable=6, step_px
 
 
 
-def download_one(url: str, out_dir: str, session: requests.Session, index: int):
+def load_etags(out_dir: str) -> dict:
     try:
-        r = session.get(url, headers=HEADERS, timeout=60, stream=True)
+        with open(os.path.join(out_dir, ETAGS_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_etags(out_dir: str, etags: dict):
+    with open(os.path.join(out_dir, ETAGS_FILE), "w", encoding="utf-8") as f:
+        json.dump(etags, f, indent=1, sort_keys=True)
+
+def download_one(url: str, out_dir: str, session: requests.Session, index: int,
+                 existing: set, etags: dict, lock: threading.Lock):
+    try:
+        # Si ya la bajamos antes (y el archivo sigue ahí), pedimos solo si cambió: el servidor responde 304 sin cuerpo
+        headers = {}
+        cached = etags.get(url)
+        cached_path = os.path.join(out_dir, cached["file"]) if cached else None
+        if cached_path and os.path.exists(cached_path):
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        else:
+            cached_path = None
+        r = session.get(url, headers=headers, timeout=60, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return cached_path, True, "Sin cambios (304)"
         r.raise_for_status()
         base = sanitize_filename(os.path.basename(urlparse(url).path) or f"image_{index}")
         root, ext = os.path.splitext(base)
         if not ext:
             ext = guess_ext_from_headers(r.headers) or ".bin"
             base = root + ext
-        final_path = os.path.join(out_dir, base)
-        counter = 1
-        while os.path.exists(final_path):
-            final_path = os.path.join(out_dir, f"{root}_{counter}{ext}")
-            counter += 1
-        with open(final_path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                if chunk:
-                    f.write(chunk)
+        # Primer nombre libre: el set de nombres ya usados descarta colisiones conocidas sin syscalls
+        # (en minúsculas, para no pisar archivos en sistemas de archivos case-insensitive) y O_EXCL
+        # crea el archivo de forma atómica, sin carreras entre hilos ni con otros procesos.
+        tmp_path = None
+        if cached_path:
+            # La imagen cambió: se reescribe la copia anterior (temporal + os.replace) en vez de sumar un _N
+            final_base, final_path = cached["file"], cached_path
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".", suffix=".part")
+        else:
+            for counter in itertools.count():
+                final_base = base if counter == 0 else f"{root}_{counter}{ext}"
+                with lock:
+                    if final_base.lower() in existing:
+                        continue
+                    existing.add(final_base.lower())
+                final_path = os.path.join(out_dir, final_base)
+                try:
+                    fd = os.open(final_path, EXCL_CREATE_FLAGS, 0o644)
+                    break
+                except FileExistsError:
+                    continue
+        # Copia directa del socket al archivo (sin el generador de iter_content), en bloques de 128 KiB
+        # sobre un buffer de 1 MiB: menos llamadas write() por imagen. decode_content descomprime gzip/deflate.
+        r.raw.decode_content = True
+        try:
+            with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+                shutil.copyfileobj(r.raw, f, length=1 << 17)
+            if tmp_path:
+                # mkstemp crea con 0600: se conservan los permisos de la copia anterior
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(final_path).st_mode))
+                os.replace(tmp_path, final_path)
+        except BaseException:
+            # Sin archivos truncados: la próxima corrida los vería como colisión y escribiría un _N
+            if tmp_path:
+                os.unlink(tmp_path)
+            else:
+                os.unlink(final_path)
+                with lock:
+                    existing.discard(final_base.lower())
+            raise
+        validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if any(validators.values()):
+            with lock:
+                etags[url] = {**validators, "file": final_base}
         return final_path, True, "OK"
     except Exception as e:
         return url, False, f"ERROR: {e}"
 
+def download_worker(url_queue: queue.Queue, out_dir: str, session: requests.Session,
+                    existing: set, etags: dict, lock: threading.Lock):
+    # Consume (index, url) de la cola hasta recibir el centinela None; devuelve (éxitos, fallos)
+    successes = failures = 0
+    while True:
+        item = url_queue.get()
+        if item is None:
+            return successes, failures
+        index, url = item
+        _, ok, msg = download_one(url, out_dir, session, index, existing, etags, lock)
+        if ok: successes += 1
+        else: failures += 1
+        print(f"[{'OK' if ok else '!!'}] {index:02d}. {msg}")
+
 def main():
     parser = argparse.ArgumentParser(description="Renderiza y descarga imágenes (incluye scroll infinito).")
     parser.add_argument("url", help="URL de la página")
@@ -200,9 +332,10 @@ def main():
     parser.add_argument("-t", "--threads", type=int, default=8, help="Descargas simultáneas")
     parser.add_argument("--viewport-w", type=int, default=1366, help="Viewport width")
     parser.add_argument("--viewport-h", type=int, default=2000, help="Viewport height")
-    parser.add_argument("--max-scrolls", type=int, default=300, help="Máximo de ciclos de scroll")
+    parser.add_argument("--max-scrolls", type=int, default=300, help="Máximo de ciclos de scroll (0 = sin scroll, solo carga forzada)")
     parser.add_argument("--sleep-ms", type=int, default=400, help="Espera entre scrolls (ms)")
     parser.add_argument("--no-headless", action="store_true", help="Mostrar navegador (debug)")
+    parser.add_argument("--load-images", action="store_true", help="No bloquear imágenes/medios/fuentes en el navegador (debug)")
     args = parser.parse_args()
 
     base_url = args.url
@@ -216,86 +349,111 @@ def main():
 
     collected_urls = set()
     lock = threading.Lock()
+    url_queue = queue.Queue()
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=not args.no_headless)
-        context = browser.new_context(user_agent=HEADERS["User-Agent"], viewport={"width": args.viewport_w, "height": args.viewport_h})
-        page = context.new_page()
-
-        # Captura de respuestas de red con imágenes
-        def on_response(response):
-            try:
-                ctype = (response.headers.get("content-type") or "").lower()
-                url = response.url
-                # Si el header dice image/*, o la URL termina como imagen, lo capturamos
-                if ("image/" in ctype) or IMAGE_EXT_RE.search(url):
-                    with lock:
-                        collected_urls.add(url)
-            except Exception:
-                pass
-
-        page.on("response", on_response)
-
-        # Cargar página
-        page.goto(base_url, wait_until="domcontentloaded", timeout=60000)
-
-        # Scroll progresivo para forzar carga perezosa
-        auto_scroll(page, max_scrolls=args.max_scrolls, sleep_ms=args.sleep_ms)
-
-        # Espera breve por últimas cargas en cola
-        page.wait_for_load_state("networkidle", timeout=15000)
-
-        # Extraer del DOM renderizado (img/srcset/data-src y background-image)
-        dom_urls = collect_from_dom(page, base_url)
+    def enqueue(urls):
+        # Encola para descarga solo las URLs que no se habían visto; el número listado es el index de download_one
         with lock:
-            collected_urls.update(dom_urls)
-
-        # Cerrar
-        context.close()
-        browser.close()
-
-    # Depuración: también intenta raspar el HTML final (por si la página dejó contenido renderizado)
-    # (No imprescindible, pero puede sumar alguna URL adicional.)
+            for u in urls:
+                if u not in collected_urls:
+                    if not collected_urls:
+                        print(f"Descargando en: {out_dir} con {args.threads} hilos (en paralelo al scroll)...")
+                    collected_urls.add(u)
+                    index = len(collected_urls)
+                    print(f"  {index:02d}. {u}")
+                    url_queue.put((index, u))
+
+    print(f"Buscando imágenes en: {base_url}")
+    start = time.time()
+    successes = failures = 0
+    # Pool keep-alive del tamaño de los hilos: con el default (10) cada hilo extra
+    # descarta su conexión y paga un handshake TCP+TLS nuevo por imagen
+    adapter = HTTPAdapter(pool_connections=args.threads, pool_maxsize=args.threads)
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+    existing = {name.lower() for name in os.listdir(out_dir)}
+    etags = load_etags(out_dir)
     try:
-        html = requests.get(base_url, headers=HEADERS, timeout=30).text
-        soup = BeautifulSoup(html, "html.parser")
-        for img in soup.find_all("img"):
-            for attr in ("src", "data-src", "data-lazy-src", "data-original"):
-                v = img.get(attr)
-                if v:
-                    collected_urls.add(urljoin(base_url, v))
-            ss = img.get("srcset")
-            if ss:
-                best = largest_from_srcset(ss)
-                if best:
-                    collected_urls.add(urljoin(base_url, best))
-    except Exception:
-        pass
-
-    # Filtrado ligero: solo http(s)
-    collected_urls = {u for u in collected_urls if urlparse(u).scheme in ("http", "https")}
+        with ThreadPoolExecutor(max_workers=args.threads) as ex:
+            # Los workers descargan mientras el navegador sigue haciendo scroll
+            workers = [ex.submit(download_worker, url_queue, out_dir, SESSION, existing, etags, lock)
+                       for _ in range(args.threads)]
+            try:
+                with sync_playwright() as p:
+                    browser = p.chromium.launch(headless=not args.no_headless)
+                    context = browser.new_context(user_agent=HEADERS["User-Agent"], viewport={"width": args.viewport_w, "height": args.viewport_h})
+                    page = context.new_page()
+
+                    # Captura de peticiones de red con imágenes: el evento "request" trae URL y tipo de recurso,
+                    # sin esperar (ni retener) el cuerpo de la respuesta
+                    # (solo http/https: blob:/data: no se pueden descargar después)
+                    def on_request(req):
+                        url = req.url
+                        if url.startswith(("http://", "https://")) and (req.resource_type == "image" or IMAGE_EXT_RE.search(url)):
+                            enqueue((url,))
+
+                    page.on("request", on_request)
+
+                    # Imágenes/medios/fuentes se abortan tras registrarse: el navegador no baja ni decodifica bytes
+                    def on_route(route):
+                        if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+                            route.abort("blockedbyclient")
+                        else:
+                            route.continue_()
+
+                    if not args.load_images:
+                        page.route("**/*", on_route)
+
+                    # Cargar página
+                    page.goto(base_url, wait_until="domcontentloaded", timeout=60000)
+
+                    # Carga forzada de las imágenes perezosas ya presentes (un solo ciclo, sin esperas fijas)
+                    force_eager_load(page)
+
+                    # Scroll progresivo para que el scroll infinito agregue contenido nuevo
+                    if args.max_scrolls > 0:
+                        auto_scroll(page, max_scrolls=args.max_scrolls, sleep_ms=args.sleep_ms)
+                        force_eager_load(page)
+
+                    # Espera breve por últimas cargas en cola (páginas con beacons/long-polling nunca quedan idle)
+                    try:
+                        page.wait_for_load_state("networkidle", timeout=15000)
+                    except Exception:
+                        pass
+
+                    # Extraer del DOM renderizado (img/srcset/data-src y background-image)
+                    enqueue(sorted(collect_from_dom(page, base_url)))
+
+                    # Cerrar
+                    context.close()
+                    browser.close()
+            except BaseException:
+                # Ctrl-C/error: descarta lo pendiente para que los workers terminen con la descarga en curso
+                while True:
+                    try:
+                        url_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                raise
+            finally:
+                # Un centinela por worker: terminan al vaciar la cola (también si el navegador falló)
+                for _ in workers:
+                    url_queue.put(None)
+            for fut in workers:
+                ok_count, fail_count = fut.result()
+                successes += ok_count
+                failures += fail_count
+    finally:
+        # También ante Ctrl-C/errores: sin esto la próxima corrida re-descarga todo como _N
+        if collected_urls:
+            save_etags(out_dir, etags)
+        SESSION.close()
 
     if not collected_urls:
         print("No se encontraron imágenes (posible contenido protegido o renderizado vía canvas).")
         return
 
     print(f"Encontradas {len(collected_urls)} imágenes únicas.")
-    for i, u in enumerate(sorted(collected_urls), 1):
-        print(f"  {i:02d}. {u}")
-
-    print(f"Descargando en: {out_dir} con {args.threads} hilos...")
-    start = time.time()
-    successes = failures = 0
-    with requests.Session() as session:
-        session.headers.update(HEADERS)
-        with ThreadPoolExecutor(max_workers=args.threads) as ex:
-            futures = {ex.submit(download_one, u, out_dir, session, i): u for i, u in enumerate(sorted(collected_urls), 1)}
-            for fut in as_completed(futures):
-                _, ok, msg = fut.result()
-                if ok: successes += 1
-                else: failures += 1
-                print(f"[{'OK' if ok else '!!'}] {msg}")
-
     print(f"Listo. Éxitos: {successes}, Fallos: {failures}, Tiempo: {time.time()-start:.1f}s")
     print(f"Carpeta de salida: {out_dir}")
 